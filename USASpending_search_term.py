@@ -1,17 +1,29 @@
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import pandas as pd
-import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv as pa_csv
 import logging
+import os
 import zipfile
+import tempfile
+import shutil
 import time
-from io import BytesIO
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from dateutil import parser as date_parser
 from pathlib import Path
+from functools import lru_cache
 #import pygsheets
 import re
+import hashlib
+import csv
 import json
+import orjson
 
 # --- Configuration Constants ---
 DOWNLOAD_URL = "https://api.usaspending.gov/api/v2/download/awards/"
@@ -20,6 +32,11 @@ HEADERS = {
     "Content-Type": "application/json",
     "User-Agent": "Mozilla/5.0"
 }
+POLL_TIMEOUT = 30 * 60  # seconds to wait on a single download job
+CHUNK_SIZE = 1024 * 1024  # block size for streaming downloads to disk
+MAX_IN_MEMORY_CSV = 512 * 1024 * 1024  # larger CSVs are extracted to disk first
+CACHE_DIR = Path(__file__).parent / '.cache'
+CACHE_TTL = 60 * 60  # seconds a downloaded ZIP is reused for the same payload
 CONFIG = {
     "google_credentials": str(Path(__file__).parent / 'creds' / 'google_sheets.json'),
     "source_sheet_id": "1j_EiY0mQKmqhHy9lC0wvd_Vs_p94yootNv180R6vZ7Y"
@@ -27,9 +44,9 @@ CONFIG = {
 
 # Award type code groups
 type_filters = {
-    'contract':     ["A","B","C","D"],
-    'contract_idv': ["IDV_A","IDV_B","IDV_B_A","IDV_B_B","IDV_B_C","IDV_C","IDV_D","IDV_E"],
-    'grant':        ["02","03","04","05"]
+    'contract':     ("A","B","C","D"),
+    'contract_idv': ("IDV_A","IDV_B","IDV_B_A","IDV_B_B","IDV_B_C","IDV_C","IDV_D","IDV_E"),
+    'grant':        ("02","03","04","05")
 }
 
 # Static filters
@@ -59,8 +76,21 @@ download_payload_template = {
     "subawards": False
 }
 
+# One ready-built payload per award type group
+PAYLOADS = {
+    atype: {
+        **download_payload_template,
+        "filters": {
+            "keywords":         static_filters["keywords"],
+            "time_period":      static_filters["time_period"],
+            "award_type_codes": codes
+        }
+    }
+    for atype, codes in type_filters.items()
+}
+
 # Columns we ultimately care about downstream
-desired_columns = [
+DESIRED_COLUMNS = (
     "award_type","award_id_fain","award_id_piid","award_or_idv_flag","parent_award_id_piid",
     "assistance_type_description","recipient_uei","recipient_name","bucket_name","recipient_parent_uei","recipient_parent_name",
     "total_obligated_amount","total_outlayed_amount","total_funding_amount","potential_total_value_of_award",
@@ -70,7 +100,18 @@ desired_columns = [
     "funding_sub_agency_name","funding_sub_agency_code","funding_office_name","funding_office_code",
     "treasure_accounts_fundins_this_award","federal_accounts_fundings_this_award","usaspending_permalink",
     "prime_award_base_transaction_description","run_datetime"
+)
+DESIRED_SET = frozenset(DESIRED_COLUMNS)
+
+# Explicit CSV schema so the parser skips type inference; dates stay strings
+# and are parsed in clean_and_filter
+numeric_columns = [
+    "total_obligated_amount","total_outlayed_amount","total_funding_amount","potential_total_value_of_award"
 ]
+csv_schema = {
+    col: pa.float64() if col in numeric_columns else pa.string()
+    for col in DESIRED_COLUMNS
+}
 
 # ------------------------------------------------------------------------------
 #  Logging setup
@@ -87,142 +128,268 @@ logger = setup_logging()
 today = datetime.today()
 
 # ------------------------------------------------------------------------------
-#  Download & status‑polling logic with retries on POST
+#  HTTP sessions (one per worker thread)
 # ------------------------------------------------------------------------------
-def download_awards(session, award_codes):
-    # build payload from our template
-    payload = download_payload_template.copy()
-    payload["filters"] = {
-        "keywords":         static_filters["keywords"],
-        "time_period":      static_filters["time_period"],
-        "award_type_codes": award_codes
-    }
+_thread_local = threading.local()
+
+def make_session():
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    retries = Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=['GET', 'POST']
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=2, max_retries=retries)
+    session.mount("https://", adapter)
+    return session
 
-    # —– SHOW THE REQUEST ON SCREEN —–
-    st.sidebar.markdown("### API Request")
-    st.sidebar.write("**POST** " + DOWNLOAD_URL)
-    st.sidebar.write("**Headers:**")
-    st.sidebar.json(dict(session.headers))
-    st.sidebar.write("**Payload:**")
-    st.sidebar.json(payload)
+def init_worker(ctx):
+    # let worker threads write to the Streamlit page and give each its own Session
+    add_script_run_ctx(threading.current_thread(), ctx)
+    _thread_local.session = make_session()
 
-    msg = f"Submitting download job for award_type_codes={award_codes}"
+# ------------------------------------------------------------------------------
+#  Download & status‑polling logic with retries on POST
+# ------------------------------------------------------------------------------
+def submit_job(session, payload, show_request=False):
+    # —– SHOW THE REQUEST ON SCREEN (debug only) —–
+    if show_request:
+        st.sidebar.markdown("### API Request")
+        st.sidebar.write("**POST** " + DOWNLOAD_URL)
+        st.sidebar.write("**Headers:**")
+        st.sidebar.json(dict(session.headers))
+        st.sidebar.write("**Payload:**")
+        st.sidebar.json(payload)
+
+    msg = f"Submitting download job for award_type_codes={payload['filters']['award_type_codes']}"
     logger.info(msg)
     st.sidebar.info(msg)
 
-    # === POST with retries ===
-    max_retries = 5
-    backoff = 1
-    for attempt in range(1, max_retries + 1):
-        try:
-            resp = session.post(DOWNLOAD_URL, json=payload)
-            resp.raise_for_status()
-            break  # success!
-        except requests.exceptions.RequestException as e:
-            logger.error(f"POST attempt {attempt}/{max_retries} failed: {e}")
-            st.sidebar.error(f"Attempt {attempt} failed: {e}")
-            if attempt == max_retries:
-                # out of retries: re‑raise
-                raise
-            logger.info(f"Retrying POST in {backoff}s...")
-            time.sleep(backoff)
-            backoff = min(backoff * 2, 30)
-
-    job_id = resp.json().get('file_name')
+    # === POST (transient failures are retried by the session's adapter) ===
+    try:
+        resp = session.post(DOWNLOAD_URL, data=orjson.dumps(payload))
+        resp.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        logger.error(f"POST failed after retries: {e}")
+        st.sidebar.error(f"Submitting download job failed: {e}")
+        raise
+
+    resp_body = orjson.loads(resp.content)
+    job_id = resp_body.get('file_name')
     if not job_id:
         raise RuntimeError("Download API did not return a job ID")
 
     st.sidebar.write(f"Download job ID: {job_id}")
     logger.info(f"Download job ID: {job_id}")
+    return job_id
+
+def poll_delay(polls):
+    # short intervals while a job is fresh, easing off for long-running ones
+    if polls < 5:
+        return 0.5
+    if polls < 25:
+        return 2
+    return 5
 
+def wait_for_url(session, job_id, status_placeholder, cancel_event):
     status_url = f"{STATUS_URL_BASE}?file_name={job_id}&type=awards"
-    delay = 1
-    status_placeholder = st.sidebar.empty()
+    polls = 0
+    last_status = None
+    started = time.monotonic()
 
     while True:
+        if cancel_event.is_set():
+            # another job failed; stop polling so the error surfaces right away
+            raise RuntimeError(f"Download job {job_id} cancelled")
+
         status_resp = session.get(status_url)
         status_resp.raise_for_status()
-        status = status_resp.json().get('status')
-        status_msg = f"Job {job_id} status: {status}"
-        logger.info(status_msg)
-        status_placeholder.text(status_msg)
+        body = orjson.loads(status_resp.content)
+        status = body.get('status')
+        if status != last_status:
+            # state changed: poll quickly again so the 'finished' edge is seen promptly,
+            # and only redraw the placeholder on changes rather than every poll
+            polls = 0
+            last_status = status
+            status_msg = f"Job {job_id} status: {status}"
+            logger.info(status_msg)
+            status_placeholder.text(status_msg)
 
         if status == 'finished':
-            download_url = status_resp.json().get('url') or status_resp.json().get('file_url')
+            download_url = body.get('url') or body.get('file_url')
             if download_url:
                 status_placeholder.write("Download URL available, fetching data...")
                 logger.info("Download URL available, fetching data...")
-                break
+                return download_url
         elif status == 'failed':
             error_msg = f"Download job {job_id} failed"
             logger.error(error_msg)
             status_placeholder.error(error_msg)
             raise RuntimeError(error_msg)
 
-        time.sleep(delay)
-        status_placeholder.write(f"Waiting {delay}s before retry...")
-        delay = min(delay * 2, 30)
+        if time.monotonic() - started > POLL_TIMEOUT:
+            error_msg = f"Download job {job_id} not finished after {POLL_TIMEOUT}s"
+            logger.error(error_msg)
+            status_placeholder.error(error_msg)
+            raise RuntimeError(error_msg)
 
-    zip_resp = session.get(download_url)
-    zip_resp.raise_for_status()
-    with zipfile.ZipFile(BytesIO(zip_resp.content)) as zf:
-        for name in zf.namelist():
-            if name.lower().endswith('.csv'):
-                with zf.open(name) as csvfile:
-                    return pd.read_csv(csvfile, low_memory=False)
-    return pd.DataFrame()
+        delay = poll_delay(polls)
+        polls += 1
+        cancel_event.wait(delay)
+
+def fetch_zip(session, download_url, zip_path):
+    # stream the archive to the cache in 1 MB blocks rather than holding it in memory;
+    # write to a uniquely named .part file first so an interrupted download is never
+    # read as a hit and concurrent sessions fetching the same payload can't interleave
+    zip_path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=zip_path.parent, suffix='.part', delete=False) as out:
+        part_path = out.name
+        try:
+            with session.get(download_url, stream=True) as zip_resp:
+                zip_resp.raise_for_status()
+                zip_resp.raw.decode_content = True
+                shutil.copyfileobj(zip_resp.raw, out, length=CHUNK_SIZE)
+        except BaseException:
+            out.close()
+            os.unlink(part_path)
+            raise
+    os.replace(part_path, zip_path)
+    return read_cached_zip(zip_path)
+
+def read_cached_zip(zip_path):
+    try:
+        return read_zip(zip_path)
+    except Exception:
+        # drop a bad cache entry so the next run downloads it again
+        zip_path.unlink(missing_ok=True)
+        raise
+
+def read_zip(zip_path):
+    with zipfile.ZipFile(zip_path) as zf:
+        for info in zf.infolist():
+            if info.file_size > 0 and info.filename.lower().endswith('.csv'):
+                return read_csv_entry(zf, info)
+    return pa.table({})
+
+def read_csv_entry(zf, info):
+    with zf.open(info) as csvfile:
+        if info.file_size <= MAX_IN_MEMORY_CSV:
+            # decompress straight into one buffer sized from the zip header
+            buf = bytearray(info.file_size)
+            view = memoryview(buf)
+            pos = 0
+            while pos < info.file_size:
+                n = csvfile.readinto(view[pos:pos + CHUNK_SIZE])
+                if not n:
+                    break
+                pos += n
+            header_end = buf.find(b'\n', 0, pos)
+            header_line = bytes(view[:header_end if header_end >= 0 else pos])
+            return read_awards_csv(pa.BufferReader(pa.py_buffer(view[:pos])), header_line)
+        with tempfile.TemporaryFile() as tmp:
+            shutil.copyfileobj(csvfile, tmp, length=CHUNK_SIZE)
+            tmp.seek(0)
+            header_line = tmp.readline()
+            tmp.seek(0)
+            return read_awards_csv(tmp, header_line)
+
+def read_awards_csv(source, header_line):
+    # only parse the columns we keep; Arrow needs an explicit list of names
+    # that exist in the file, so take them from the header row
+    header = next(csv.reader([header_line.decode('utf-8-sig')]), [])
+    convert_options = pa_csv.ConvertOptions(
+        include_columns=[c for c in header if c in DESIRED_SET],
+        column_types=csv_schema,
+        strings_can_be_null=True
+    )
+    # descriptions are free text and can hold quoted newlines
+    parse_options = pa_csv.ParseOptions(newlines_in_values=True)
+    table = pa_csv.read_csv(source, parse_options=parse_options, convert_options=convert_options)
+
+    # normalise the IDV/AWARD flag once here so classification can compare exactly
+    if 'award_or_idv_flag' in table.column_names:
+        table = replace_column(table, 'award_or_idv_flag', pc.utf8_upper(table['award_or_idv_flag']))
+    return table
+
+def replace_column(table, name, column):
+    if name in table.column_names:
+        return table.set_column(table.column_names.index(name), name, column)
+    return table.append_column(name, column)
+
+def collect_awards(job_id, zip_path, status_placeholder, cancel_event):
+    # runs on a worker thread: poll until the file is ready, then download it
+    session = _thread_local.session
+    download_url = wait_for_url(session, job_id, status_placeholder, cancel_event)
+    return fetch_zip(session, download_url, zip_path)
 
 # ------------------------------------------------------------------------------
-#  Cleaning & filtering (including client‑side keyword & date logic)
+#  Local download cache (one ZIP per distinct payload)
 # ------------------------------------------------------------------------------
-def clean_and_filter(df, keywords):
-    df = df.copy()
+def cache_path(payload):
+    digest = hashlib.sha1(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+    return CACHE_DIR / f"{digest}.zip"
 
-    # classify award_type
-    conds = [
-        df['award_or_idv_flag'].str.upper().eq('IDV')  & df['award_id_piid'].notna(),
-        df['award_or_idv_flag'].str.upper().eq('AWARD')& df['award_id_piid'].notna()
-    ]
-    df['award_type'] = np.select(conds, ['contract_idv','contract'], default='grant')
-
-    # parse dates safely
-    def parse_or_none(val):
-        if pd.isna(val) or str(val).strip()=='':
-            return None
-        try:
-            return date_parser.parse(str(val))
-        except Exception:
-            return None
+def is_fresh(zip_path):
+    return zip_path.exists() and time.time() - zip_path.stat().st_mtime < CACHE_TTL
 
+# ------------------------------------------------------------------------------
+#  Cleaning & filtering (including client‑side keyword & date logic)
+# ------------------------------------------------------------------------------
+@lru_cache(maxsize=32)
+def keyword_pattern(keywords):
+    # inline (?i) so the Arrow regex engine matches case-insensitively itself
+    return "(?i)" + "|".join(re.escape(k) for k in keywords)
+
+def clean_and_filter(table, keywords):
+    # runs on the Arrow table with pyarrow.compute kernels; pandas is only built for display
+    # classify award_type (award_or_idv_flag is already uppercased by read_awards_csv)
+    flag = table['award_or_idv_flag']
+    has_piid = pc.is_valid(table['award_id_piid'])
+    is_idv = pc.and_(pc.fill_null(pc.equal(flag, 'IDV'), False), has_piid)
+    is_award = pc.and_(pc.fill_null(pc.equal(flag, 'AWARD'), False), has_piid)
+    award_type = pc.if_else(is_idv, 'contract_idv', pc.if_else(is_award, 'contract', 'grant'))
+    table = replace_column(table, 'award_type', award_type)
+
+    # parse dates (YYYY-MM-DD); blanks and bad values become null
     for col in [
         'period_of_performance_potential_end_date',
         'period_of_performance_current_end_date',
         'ordering_period_end_date'
     ]:
-        df[col] = df[col].apply(parse_or_none)
-
-    # keep only future‑relevant records
-    df = df.loc[
-        ((df['award_type']=='contract')     & (df['period_of_performance_potential_end_date'] > today)) |
-        ((df['award_type']=='grant')        & (df['period_of_performance_current_end_date']   > today)) |
-        ((df['award_type']=='contract_idv') & (df['ordering_period_end_date']                  > today))
-    ].copy()
+        parsed = pc.strptime(table[col], format='%Y-%m-%d', unit='us', error_is_null=True)
+        table = replace_column(table, col, parsed)
+
+    # keep only future‑relevant records: pick each row's end date by type, compare once
+    relevant_end = pc.if_else(
+        pc.equal(award_type, 'contract'), table['period_of_performance_potential_end_date'],
+        pc.if_else(
+            pc.equal(award_type, 'grant'), table['period_of_performance_current_end_date'],
+            table['ordering_period_end_date']
+        )
+    )
+    mask = pc.fill_null(pc.greater(relevant_end, pa.scalar(today, pa.timestamp('us'))), False)
 
-    # apply keyword filter again client‑side
+    # apply keyword filter again client‑side: the server matches keywords in any
+    # field, this narrows results to the transaction description
     if keywords:
-        pattern = "|".join(re.escape(k) for k in keywords)
-        df = df.loc[
-            df['prime_award_base_transaction_description']
-              .str.contains(pattern, case=False, na=False)
-        ]
+        matches = pc.match_substring_regex(
+            table['prime_award_base_transaction_description'],
+            keyword_pattern(tuple(keywords))
+        )
+        mask = pc.and_(mask, pc.fill_null(matches, False))
+
+    table = table.filter(mask)
 
     # merge PIID/FAIN for downstream
-    df['piid_or_fain'] = (
-        df['award_id_fain'].fillna('').astype(str) +
-        df['award_id_piid'].fillna('').astype(str)
+    piid_or_fain = pc.binary_join_element_wise(
+        pc.fill_null(table['award_id_fain'], ''),
+        pc.fill_null(table['award_id_piid'], ''),
+        ''
     )
-    df.drop(columns=['award_id_fain','award_id_piid'], inplace=True, errors='ignore')
-    return df
+    table = table.append_column('piid_or_fain', piid_or_fain)
+    return table.drop_columns([c for c in ['award_id_fain','award_id_piid'] if c in table.column_names])
 
 # ------------------------------------------------------------------------------
 #  Push to Google Sheets
@@ -266,35 +433,66 @@ keywords_input = st.sidebar.text_input(
     ", ".join(static_filters["keywords"])
 )
 keywords = [k.strip() for k in keywords_input.split(',') if k.strip()]
+show_request = st.sidebar.checkbox("Debug request", value=False)
 
 if st.sidebar.button("Fetch Awards"):
-    session = requests.Session()
-    session.headers.update(HEADERS)
+    session = make_session()
 
-    data_frames = []
+    tables = []
     total_types = len(type_filters)
     status_main  = st.sidebar.empty()
     progress_bar = st.sidebar.progress(0)
 
-    for idx, (atype, codes) in enumerate(type_filters.items(), start=1):
-        status_main.text(f"Fetching {atype} awards ({idx}/{total_types})...")
-        df = download_awards(session, codes)
-        if df.empty:
-            st.sidebar.warning(f"No data for '{atype}' awards")
-        else:
-            status_main.success(f"Fetched {len(df)} records for {atype}")
-            df['award_type'] = atype
-            data_frames.append(df)
-        progress_bar.progress(int(idx / total_types * 100))
-
-    if not data_frames:
+    zip_paths = {atype: cache_path(payload) for atype, payload in PAYLOADS.items()}
+
+    # submit every uncached job up front so the server prepares them side by side
+    status_main.text("Submitting download jobs...")
+    job_ids = {
+        atype: submit_job(session, payload, show_request)
+        for atype, payload in PAYLOADS.items()
+        if not is_fresh(zip_paths[atype])
+    }
+
+    status_main.text(f"Waiting on {len(job_ids)} download jobs...")
+    cancel_event = threading.Event()
+    with ThreadPoolExecutor(
+        max_workers=total_types,
+        initializer=init_worker,
+        initargs=(get_script_run_ctx(),)
+    ) as executor:
+        futures = {}
+        for atype, zip_path in zip_paths.items():
+            if atype in job_ids:
+                future = executor.submit(collect_awards, job_ids[atype], zip_path, st.sidebar.empty(), cancel_event)
+            else:
+                logger.info(f"Using cached download for {atype}: {zip_path}")
+                future = executor.submit(read_cached_zip, zip_path)
+            futures[future] = atype
+        for idx, future in enumerate(as_completed(futures), start=1):
+            atype = futures[future]
+            try:
+                table = future.result()
+            except Exception:
+                # fail fast: stop the other pollers instead of waiting out their jobs
+                cancel_event.set()
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+            if table.num_rows == 0:
+                st.sidebar.warning(f"No data for '{atype}' awards")
+            else:
+                status_main.success(f"Fetched {table.num_rows} records for {atype} ({idx}/{total_types})")
+                tables.append(replace_column(table, 'award_type', pa.array([atype] * table.num_rows, pa.string())))
+            progress_bar.progress(int(idx / total_types * 100))
+
+    if not tables:
         status_main.error("No data downloaded for any award type.")
         st.error("No data downloaded for any award type.")
     else:
         status_main.text("Combining and filtering data...")
-        combined = pd.concat(data_frames, ignore_index=True)
-        combined = combined[[c for c in desired_columns if c in combined.columns]]
-        filtered_df = clean_and_filter(combined, keywords)
+        # concatenating Arrow tables only stacks chunks; pandas is built once, after filtering
+        combined_tbl = pa.concat_tables(tables, promote_options='default')
+        combined_tbl = combined_tbl.select([c for c in DESIRED_COLUMNS if c in combined_tbl.column_names])
+        filtered_df = clean_and_filter(combined_tbl, keywords).to_pandas(types_mapper=pd.ArrowDtype)
         status_main.success(f"Found {len(filtered_df)} records matching your criteria.")
         st.dataframe(filtered_df)
 
@@ -0,0 +1,42 @@
+import pyarrow as pa
+
+import USASpending_search_term as app
+
+
+def test_mixed_case_award_or_idv_flag_is_classified():
+    csv = (
+        b"award_id_piid,award_id_fain,award_or_idv_flag,"
+        b"period_of_performance_potential_end_date,period_of_performance_current_end_date,"
+        b"ordering_period_end_date,prime_award_base_transaction_description\n"
+        b"P1,,Award,2099-01-01,2000-01-01,,wsj\n"
+        b"I1,,Idv,,,2099-01-01,wsj\n"
+        b",F1,,,2099-01-01,,wsj\n"
+    )
+    header = csv.split(b"\n", 1)[0]
+    # the flag is normalised by read_awards_csv, so go through it like the app does
+    table = app.read_awards_csv(pa.BufferReader(csv), header)
+
+    result = app.clean_and_filter(table, [])
+
+    assert dict(zip(result["piid_or_fain"].to_pylist(), result["award_type"].to_pylist())) == {
+        "P1": "contract",
+        "I1": "contract_idv",
+        "F1": "grant",
+    }
+
+
+def test_default_keywords_still_filter_descriptions():
+    csv = (
+        b"award_id_piid,award_id_fain,award_or_idv_flag,"
+        b"period_of_performance_potential_end_date,period_of_performance_current_end_date,"
+        b"ordering_period_end_date,prime_award_base_transaction_description\n"
+        b"P1,,AWARD,2099-01-01,,,Wall Street Journal subscription\n"
+        b"P2,,AWARD,2099-01-01,,,office supplies\n"
+    )
+    header = csv.split(b"\n", 1)[0]
+    table = app.read_awards_csv(pa.BufferReader(csv), header)
+
+    # the server's keyword match covers every field; the client keeps description matches only
+    result = app.clean_and_filter(table, app.static_filters["keywords"])
+
+    assert result["piid_or_fain"].to_pylist() == ["P1"]
@@ -0,0 +1,55 @@
+import zipfile
+
+import pyarrow as pa
+import pytest
+
+import USASpending_search_term as app
+
+HEADER = b"award_id_piid,award_or_idv_flag,prime_award_base_transaction_description"
+
+
+def multiline_csv(n_rows):
+    rows = b"".join(
+        b'P%d,AWARD,"Wall Street Journal, line one of %d\nline two"\n' % (i, i)
+        for i in range(n_rows)
+    )
+    return HEADER + b"\n" + rows
+
+
+def test_read_awards_csv_multiline_descriptions_over_one_block():
+    data = multiline_csv(100_000)
+    assert len(data) > 1024 * 1024  # larger than one Arrow parse block
+
+    table = app.read_awards_csv(pa.BufferReader(data), HEADER)
+
+    assert table.num_rows == 100_000
+    assert table["prime_award_base_transaction_description"][0].as_py() == (
+        "Wall Street Journal, line one of 0\nline two"
+    )
+    assert table["award_id_piid"][-1].as_py() == "P99999"
+
+
+@pytest.mark.parametrize("in_memory", [True, False])
+def test_read_zip_multiline_descriptions(tmp_path, monkeypatch, in_memory):
+    if not in_memory:
+        monkeypatch.setattr(app, "MAX_IN_MEMORY_CSV", 0)  # force the temp-file path
+    zip_path = tmp_path / "awards.zip"
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("empty.csv", "")
+        zf.writestr("awards.csv", multiline_csv(100_000))
+
+    table = app.read_zip(zip_path)
+
+    assert table.num_rows == 100_000
+    assert table["award_or_idv_flag"].unique().to_pylist() == ["AWARD"]
+
+
+def test_read_cached_zip_drops_corrupt_entry(tmp_path):
+    zip_path = tmp_path / "awards.zip"
+    zip_path.write_bytes(b"not a zip")
+
+    with pytest.raises(zipfile.BadZipFile):
+        app.read_cached_zip(zip_path)
+
+    assert not zip_path.exists()
+    assert not app.is_fresh(zip_path)